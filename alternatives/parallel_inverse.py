@@ -3,9 +3,17 @@ import numpy as np
 from dask.distributed import as_completed
 
 
-def group_by(a):
-    a = a[a[:, 0].argsort()]
-    return np.split(a[:, 1], np.unique(a[:, 0], return_index=True)[1][1:])
+def group_by(keys):
+    # sort a permutation of the indexes by key, the indexes in the i-th group
+    # are order[boundaries[i] : boundaries[i+1]]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    changes = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1])
+    boundaries = np.empty(len(changes) + 2, dtype=int)
+    boundaries[0] = 0
+    boundaries[1:-1] = changes + 1
+    boundaries[-1] = len(sorted_keys)
+    return order, boundaries
 
 
 def bin_content_tuple(bin_content, pts, bin_coords):
@@ -20,27 +28,27 @@ def fill_bins(
     pts_per_future,
     client,
 ):
-    bin_coords = np.floor_divide(
-        pts, uniform_grid_cell_size * bins_size
-    ).astype(int)
+    bins_per_axis = uniform_grid_cell_count // bins_size
+
+    # truncation is the same as floor for non-negative coordinates
+    bin_coords = (pts / (uniform_grid_cell_size * bins_size)).astype(np.int32)
     # moves to the last bin of the axis any point which is outside the region
     # defined by samples2.
-    np.clip(bin_coords, None, uniform_grid_cell_count - 1, out=bin_coords)
+    np.minimum(bin_coords, bins_per_axis - 1, out=bin_coords)
 
-    bins_per_axis = uniform_grid_cell_count // bins_size
-
-    shifted_nbins_per_axis = np.ones_like(bins_per_axis, dtype=int)
-    shifted_nbins_per_axis[:-1] = bins_per_axis[1:]
     # for each non-uniform point, this gives the linearized coordinate of the
     # appropriate bin
-    linearized_bin_coords = np.dot(bin_coords, shifted_nbins_per_axis[:, None])
-    aug_linearized_bin_coords = np.hstack(
-        [linearized_bin_coords, np.arange(len(pts))[:, None]]
+    linearized_bin_coords = np.ravel_multi_index(
+        bin_coords.T, dims=tuple(bins_per_axis)
     )
 
     # group by puts into the same group those points which are in the same bin.
     # anyway points in different bins cannot be in the same future
-    indexes_inside_bins = group_by(aug_linearized_bin_coords)
+    order, boundaries = group_by(linearized_bin_coords)
+    indexes_inside_bins = (
+        order[boundaries[i] : boundaries[i + 1]]
+        for i in range(len(boundaries) - 1)
+    )
 
     if pts_per_future != -1:
         # indexes inside bins splitted according to pts_per_future
@@ -54,7 +62,7 @@ def fill_bins(
             )
         )
     else:
-        subgroups_inside_bins = [list(map(np.array, indexes_inside_bins))]
+        subgroups_inside_bins = [list(indexes_inside_bins)]
 
     bin_coords_fu = client.scatter(bin_coords, broadcast=True)
     pts_fu = client.scatter(pts, broadcast=True)
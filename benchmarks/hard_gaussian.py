@@ -4,8 +4,10 @@ from dask.distributed import Client
 
 t = np.linspace(0, 2, 500)
 rng = np.random.default_rng(seed=2)
-x, y = np.meshgrid(t, t)
-samples1 = np.stack((x.flatten(), y.flatten()), axis=-1)
+# same points of np.meshgrid(t, t), without the meshgrid temporaries
+samples1 = np.empty((len(t) ** 2, 2))
+samples1[:, 0] = np.tile(t, len(t))
+samples1[:, 1] = np.repeat(t, len(t))
 samples2 = np.stack(
     (2 * rng.random(size=50), 2 * rng.random(size=50)), axis=-1
 )
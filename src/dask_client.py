@@ -1,4 +1,7 @@
+from itertools import islice
+
 import numpy as np
+import numba as nb
 
 from dask.distributed import as_completed
 
@@ -9,54 +12,60 @@ from numpy_dimensional_utils import (
 )
 
 
-def group_by(a):
+def group_by(linearized_bin_coords):
     r"""
-    Groups the values in `a[:,1]` according to the values in `a[:,0]`. Produces
-    a list of lists, each inner list is the set of values in `a[:,1]` that
-    share a common value in the first column.
+    Groups the indexes of `linearized_bin_coords` according to their value
+    (i.e. the bin they belong to). Instead of producing a list of arrays, the
+    grouping is represented by a permutation of the indexes and a set of
+    boundaries: the indexes inside the `i`-th non-empty bin are
+    `order[boundaries[i] : boundaries[i+1]]`.
 
     Parameters
     ----------
-    a: np.ndarray
-        2D NumPy array, should have two columns. The first one contains the
-        reference values to be used for the grouping, the second should
-        contain the values to be grouped.
+    linearized_bin_coords: np.ndarray
+        1D NumPy array of integers, the linearized coordinate of the bin which
+        contains each point.
 
     Returns
     -------
-    `list`
-    A list of grouped values from the second column of `a`, according to the
-    first column of `a`.
+    `tuple`
+    A tuple `(order, boundaries)`. `order` is a 1D NumPy array which contains
+    the indexes of `linearized_bin_coords` sorted by bin, `boundaries` is a 1D
+    NumPy array whose size is the number of non-empty bins plus one.
 
     Example
     -------
     The expected returned value for:
 
-        >>> bin_coords = [
-        ...     [0, 1],
-        ...     [1, 2],
-        ...     [1, 3],
-        ...     [0, 4],
-        ...     [2, 5]
-        >>> ]
+        >>> linearized_bin_coords = [1, 2, 2, 1, 0]
 
-    is `[[1,4], [2,3], [5]]`.
+    is `([4, 0, 3, 1, 2], [0, 1, 3, 5])`.
     """
 
-    a = a[a[:, 0].argsort()]
-    return np.split(a[:, 1], np.unique(a[:, 0], return_index=True)[1][1:])
+    order = np.argsort(linearized_bin_coords, kind="stable")
+    sorted_coords = linearized_bin_coords[order]
+
+    # a new group starts where the (sorted) bin changes. we only look at the
+    # sorted data, thus empty bins cost nothing
+    changes = np.flatnonzero(sorted_coords[1:] != sorted_coords[:-1])
+    boundaries = np.empty(len(changes) + 2, dtype=int)
+    boundaries[0] = 0
+    boundaries[1:-1] = changes + 1
+    boundaries[-1] = len(sorted_coords)
+    return order, boundaries
 
 
-def extract_subproblems(indexes, n_per_subgroup):
+def extract_subproblems(order, boundaries, n_per_subgroup):
     r"""
     Given a set of indexes grouped by bin, extract subproblems from each bin
     according to the parameter `n_per_subgroup`.
 
     Parameters
     ----------
-    indexes: list
-        `list` of list. Each inner list contains the set of indexes inside
-        the corresponding bin.
+    order: np.ndarray
+        Indexes sorted by bin, as returned by :func:`group_by`.
+    boundaries: np.ndarray
+        Boundaries of the bins in `order`, as returned by :func:`group_by`.
     n_per_subgroup: int
         Number of points in a subproblem. If `-1`, then there's no upper bound.
 
@@ -66,19 +75,38 @@ def extract_subproblems(indexes, n_per_subgroup):
     An iterable whose elements correspond to bins. Each iterable wraps an
     iterable of subproblems.
     """
+    # slices of `order` are views, no copy of the indexes is needed
+    bins_content = (
+        order[boundaries[i] : boundaries[i + 1]]
+        for i in range(len(boundaries) - 1)
+    )
+
     if n_per_subgroup != -1:
         return map(
             # here we apply the finer granularity (#pts per future)
             lambda arr: np.array_split(
                 arr, np.ceil(len(arr) / n_per_subgroup)
             ),
-            indexes,
+            bins_content,
         )
     else:
-        # we transform the lists of indexes in indexes_inside_bins to NumPy
-        # arrays. we also wrap them into 1-element tuples because of how we
-        # treat them in client.map
-        return map(lambda arr: (np.array(arr),), indexes)
+        # we wrap bins into 1-element tuples because of how we treat them in
+        # client.map
+        return map(lambda arr: (arr,), bins_content)
+
+
+def bin_content_tuple(bin_content, bin_lower_left, pts_weights):
+    r"""
+    Build the tuple which describes a subproblem, see the value returned by
+    :func:`distribute_subproblems`. Executed on the worker.
+    """
+    pts, weights = pts_weights
+    return (
+        pts[:, bin_content],
+        bin_lower_left,
+        bin_content,
+        weights[bin_content],
+    )
 
 
 def distribute_subproblems(
@@ -110,8 +138,9 @@ def distribute_subproblems(
         1D array whose length is the number of dimensions of the space.
     pts: np.ndarray
         Non-uniform points scattered in the uniform grid. Expected a 2D NumPy
-        array whose number of rows is the number of points, and whose number of
-        columns is the number of dimensions of the space.
+        array whose number of rows is the number of dimensions of the space,
+        and whose number of columns is the number of points (i.e. one
+        contiguous row for each axis).
     weights: np.ndarray
         Weights defined as for the parameter `weights` in
         :func:`mapped_distance_matrix`.
@@ -127,76 +156,181 @@ def distribute_subproblems(
     Returns
     -------
     `iterable`
-    An iterable of Dask Future, one for each subproblem. Each Future encloses a
+    An iterable of Dask Future, one for each subproblem, sorted by decreasing
+    number of points. Each Future encloses a
     tuple which contains three values:
 
-        1. Points in the subproblem (a 2D NumPy array);
-        2. (Non-linearized) coords of the bin which contains the subproblem;
+        1. Points in the subproblem (a 2D NumPy array, one row per axis);
+        2. Location of the lower left point of the bin which contains the
+           subproblem, in terms of uniform grid cells;
         3. Indexes of the non-uniform points in this subproblem wrt `pts`;
         4. Weights for the non uniform points in this subproblem.
     """
     bins_per_axis = uniform_grid_size // bins_size
 
-    # periodicity
-    pts = np.mod(pts, (uniform_grid_size * uniform_grid_cell_step)[None])
-
-    pts_bin_coords = np.floor_divide(
-        pts, uniform_grid_cell_step * bins_size
-    ).astype(int)
+    # periodicity. the period is cast to the type of the points, otherwise
+    # single precision points would be promoted to double precision
+    period = (uniform_grid_size * uniform_grid_cell_step).astype(pts.dtype)
+    pts = np.mod(pts, period[:, None])
+
+    # truncation is the same as floor since coordinates are non-negative.
+    # the division might round up to the number of bins for points very close
+    # to the upper boundary of the grid, we move them to the last bin
+    pts_bin_coords = (
+        pts / (uniform_grid_cell_step * bins_size)[:, None]
+    ).astype(np.int32)
+    np.minimum(
+        pts_bin_coords, (bins_per_axis - 1)[:, None], out=pts_bin_coords
+    )
 
     # transform the N-Dimensional bins indexing (N is the number of axes)
     # into a linear one (only one index)
-    linearized_bin_coords = np.ravel_multi_index(
-        pts_bin_coords.T, bins_per_axis
-    )
-    # augment the linear indexing with the index of the point before using
-    # group by, in order to have an index that we can use to access the
-    # pts array
-    aug_linearized_bin_coords = np.stack(
-        (linearized_bin_coords, np.arange(len(pts))), axis=-1
-    )
-    indexes_inside_bins = group_by(aug_linearized_bin_coords)
+    linearized_bin_coords = np.ravel_multi_index(pts_bin_coords, bins_per_axis)
+    # group the indexes of the points (which we use to access the pts
+    # array) by bin
+    order, boundaries = group_by(linearized_bin_coords)
 
     # we create subproblems for each bin (i.e. we split points in the
     # same bin in order to treat at most pts_per_future points in each Future)
-    subproblems = extract_subproblems(indexes_inside_bins, pts_per_future)
+    subproblems = extract_subproblems(order, boundaries, pts_per_future)
     # each subproblem is treated by a single Future. each bin spawns one or
     # more subproblems.
 
+    # the cost of a subproblem is proportional to the number of points in it
+    # (all bins share the same reference bin), we put the biggest subproblems
+    # first so that they do not delay the end of the computation
+    subgroups = tuple(
+        sorted(
+            (
+                subgroup
+                for bin_content in subproblems
+                for subgroup in bin_content
+            ),
+            key=len,
+            reverse=True,
+        )
+    )
+    # the bin is the same for all the points in a subproblem, thus we compute
+    # the location of its lower left point (in terms of uniform grid cells)
+    # here, for all the subproblems at once, instead of moving the
+    # coordinates of all the points to the workers
+    subgroups_bin_lower_left = tuple(
+        pts_bin_coords[
+            :, np.fromiter((subgroup[0] for subgroup in subgroups), dtype=int)
+        ].T
+        * bins_size
+    )
+
+    # points and weights are moved to the workers together, only once. the
+    # key is not derived from the content, otherwise consecutive calls with
+    # the same points would share (and release) the same data
+    pts_weights = (pts, weights)
     if scatter:
-        bin_coords_fu = client.scatter(pts_bin_coords, broadcast=True)
-        pts_fu = client.scatter(pts, broadcast=True)
-    else:
-        bin_coords_fu = pts_bin_coords
-        pts_fu = pts
-
-    def bin_content_tuple(bin_content, pts, pts_bin_coords):
-        return (
-            pts[bin_content],
-            pts_bin_coords[bin_content[0]],
-            bin_content,
-            weights[bin_content],
+        [pts_weights] = client.scatter(
+            [pts_weights], broadcast=True, hash=False
         )
 
     return client.map(
         bin_content_tuple,
-        tuple(
-            subgroup for bin_content in subproblems for subgroup in bin_content
-        ),
-        pts=pts_fu,
-        pts_bin_coords=bin_coords_fu,
+        subgroups,
+        subgroups_bin_lower_left,
+        pts_weights=pts_weights,
     )
 
 
+# no parallel=True: this runs inside Dask workers, which already provide
+# the parallelism. fastmath is restricted to flags which do not change the
+# rounding of the sum, points lying on the max distance must not flip
+@nb.jit(
+    nopython=True, fastmath={"nnan", "ninf"}, cache=True, nogil=True
+)
+def squared_distances(uniform_grid, subgroup, out):
+    r"""
+    Compute the squared distance between each point of `uniform_grid` and each
+    point of `subgroup`. The result is stored in `out`.
+
+    Parameters
+    ----------
+    uniform_grid: np.ndarray
+        2D C-contiguous NumPy array of shape `(D, G)`.
+    subgroup: np.ndarray
+        2D C-contiguous NumPy array of shape `(D, S)`.
+    out: np.ndarray
+        2D C-contiguous NumPy array of shape `(G, S)`.
+    """
+    D, G = uniform_grid.shape
+    S = subgroup.shape[1]
+    for g in range(G):
+        for s in range(S):
+            out[g, s] = 0
+        # the innermost loop runs along contiguous rows of `subgroup` and
+        # `out`. the order of the sum over the axes is the same of a
+        # point-by-point loop, thus the rounding is not affected
+        for k in range(D):
+            for s in range(S):
+                diff = uniform_grid[k, g] - subgroup[k, s]
+                out[g, s] += diff * diff
+
+
+def reference_bin_bounds_near_subgroup(reference_bin, subgroup, max_distance):
+    r"""
+    Find the smallest (multi-dimensional) slice of `reference_bin` which
+    contains all the uniform points whose distance from the bounding box of
+    `subgroup` is not greater than `max_distance`. Points outside the slice
+    cannot be nearby any point in `subgroup`.
+
+    Parameters
+    ----------
+    reference_bin: np.ndarray
+        Reference bin, one row for each axis (shape `(D, *bin_shape)`).
+    subgroup: np.ndarray
+        Non-uniform points (translated in the frame of the reference bin), one
+        row for each axis (shape `(D, S)`).
+    max_distance: float
+        Maximum distance between a pair uniform/non-uniform point to be
+        considered not zero.
+
+    Returns
+    -------
+    `tuple`
+    Lower bounds (included) and upper bounds (excluded) of the slice, in
+    terms of cells of the reference bin.
+    """
+    D = len(reference_bin)
+    lower_bounds = np.empty(D, dtype=int)
+    upper_bounds = np.empty(D, dtype=int)
+    for axis in range(D):
+        # coordinates of the uniform points along `axis`
+        axis_coords = reference_bin[
+            (axis,) + (0,) * axis + (slice(None),) + (0,) * (D - axis - 1)
+        ]
+        # we keep one more cell on both sides, a point lying exactly on the
+        # max distance must not be lost because of rounding
+        lower_bounds[axis] = (
+            np.searchsorted(
+                axis_coords, subgroup[axis].min() - max_distance, "left"
+            )
+            - 1
+        )
+        upper_bounds[axis] = (
+            np.searchsorted(
+                axis_coords, subgroup[axis].max() + max_distance, "right"
+            )
+            + 1
+        )
+    np.clip(lower_bounds, 0, None, out=lower_bounds)
+    np.minimum(upper_bounds, reference_bin.shape[1:], out=upper_bounds)
+    return lower_bounds, upper_bounds
+
+
 def compute_mapped_distance_on_subgroup(
     subgroup_info,
     uniform_grid_cell_step,
     uniform_grid_size,
-    bins_size,
     max_distance,
-    max_distance_in_cells,
     function,
     exact_max_distance,
+    squared_distance,
     reference_bin,
     dtype,
 ):
@@ -208,36 +342,83 @@ def compute_mapped_distance_on_subgroup(
     -------
     `tuple`
     """
-    subgroup, bin_coords, nup_idxes, weights = subgroup_info
-
-    # location of the lower left point of the non-padded bin in terms
-    # of uniform grid cells
-    bin_virtual_lower_left = bin_coords * bins_size
-    # location of the upper right point of the non-padded bin
-    bin_virtual_upper_right = bin_virtual_lower_left + bins_size - 1
+    subgroup, bin_virtual_lower_left, nup_idxes, weights = subgroup_info
+    # the distance kernel and BLAS need C-contiguous data of the expected
+    # type, otherwise they would copy silently (or fall back to slow paths).
+    # :func:`mapped_distance_matrix` already provides it, thus no copy is
+    # done unless this function is called with different data
+    weights = np.ascontiguousarray(weights, dtype=dtype)
+    reference_bin = np.ascontiguousarray(reference_bin, dtype=dtype)
 
     # translate the subgroup in order to locate it nearby the reference bin
     # (reminder: the lower left point of the (non-padded) reference bin is
-    # [0,0]).
-    subgroup -= bin_virtual_lower_left * uniform_grid_cell_step
-
-    distances = np.linalg.norm(
-        reference_bin[:, :, None] - subgroup[None, None],
-        axis=-1,
+    # [0,0]). the result is a new array: `subgroup` is owned by the Future of
+    # the subproblem, which may be shared with other computations
+    subgroup = np.subtract(
+        subgroup,
+        (bin_virtual_lower_left * uniform_grid_cell_step)[:, None],
+        dtype=dtype,
+        order="C",
     )
 
     if exact_max_distance:
-        nearby = distances <= max_distance
-        mapped_distance = np.zeros_like(distances, dtype=dtype)
-        mapped_distance[nearby] = function(distances[nearby])
+        # uniform points too far from the subgroup give no contribution, we
+        # only keep the slice of the reference bin around the subgroup
+        lower_bounds, upper_bounds = reference_bin_bounds_near_subgroup(
+            reference_bin, subgroup, max_distance
+        )
+        reference_bin = np.ascontiguousarray(
+            reference_bin[
+                (slice(None),)
+                + tuple(
+                    slice(lower, upper)
+                    for lower, upper in zip(lower_bounds, upper_bounds)
+                )
+            ]
+        )
+    else:
+        lower_bounds = np.zeros_like(bin_virtual_lower_left)
+        upper_bounds = np.array(reference_bin.shape[1:])
+
+    # we do not expand the square as |g|^2 + |s|^2 - 2 g.s because
+    # cancellation would make the cutoff unreliable for points close to the
+    # max distance
+    dist2 = np.empty(
+        (*reference_bin.shape[1:], subgroup.shape[1]),
+        dtype=np.result_type(reference_bin, subgroup),
+    )
+    squared_distances(
+        reference_bin.reshape(len(reference_bin), -1),
+        subgroup,
+        dist2.reshape(-1, subgroup.shape[1]),
+    )
+
+    if squared_distance:
+        # `function` is evaluated in place on the whole buffer, the entries
+        # beyond the max distance are zeroed afterwards. this is a single pass
+        # instead of gathering and scattering the nearby entries
+        if exact_max_distance:
+            far = dist2 > max_distance * max_distance
+        mapped_distance = function(dist2, out=dist2)
+        if exact_max_distance:
+            mapped_distance[far] = 0
+    elif exact_max_distance:
+        # the comparison is done on squared distances, so that we take the
+        # square root only for the entries which survive the cutoff
+        nearby = dist2 <= max_distance * max_distance
+        mapped_distance = np.zeros_like(dist2, dtype=dtype)
+        mapped_distance[nearby] = function(np.sqrt(dist2[nearby]))
     else:
-        mapped_distance = function(distances)
+        mapped_distance = function(np.sqrt(dist2, out=dist2))
 
-    # we add one because the upper bound is not included
+    # the cell [0,0] of the reference bin corresponds to the lower left
+    # point of the bin in the padded global matrix
     bin_bounds = np.array(
-        [bin_virtual_lower_left, bin_virtual_upper_right + 1]
+        [
+            bin_virtual_lower_left + lower_bounds,
+            bin_virtual_lower_left + upper_bounds,
+        ]
     )
-    bin_bounds[1] += 2 * max_distance_in_cells
 
     return mapped_distance.dot(weights), bin_bounds
 
@@ -284,6 +465,7 @@ def mapped_distance_matrix(
     dtype=None,
     cell_reference_point_offset=0,
     scatter=True,
+    squared_distance=False,
 ):
     r"""
     Compute the mapped distance matrix of a set of non uniform points
@@ -322,6 +504,11 @@ def mapped_distance_matrix(
     pts_per_future: int
         Number of points in a subproblem. If `pts_per_future=-1`, then there's
         no upper bound.
+    dtype: np.dtype
+        Floating point type used for the computation and for the result. By
+        default the type of `non_uniform_points` if it is a floating point
+        type, `np.float64` otherwise. Single precision (`np.float32`) halves
+        the memory traffic.
     cell_reference_point_offset: np.array or int
         Offset of the reference point (i.e. the point used to compute the
         distance between a cell and a non-uniform point) from the bottom left
@@ -331,6 +518,15 @@ def mapped_distance_matrix(
     scatter: boolean
         If true, data is "scattered" (i.e. `Client.scatter`) before starting
         the computation.
+    squared_distance: boolean
+        If true, `func` receives the squared distance instead of the distance.
+        This saves a square root for each pair uniform/non-uniform point, and
+        is convenient for functions which depend only on the squared distance
+        (e.g. a Gaussian). In this case `func` is called as
+        `func(squared_distances, out=squared_distances)` and may work in
+        place on its argument (e.g.
+        `lambda r2, out: np.exp(-r2 * inv_2sigma2, out=out)`). Its return
+        value is used as the result.
 
     Returns
     -------
@@ -340,9 +536,23 @@ def mapped_distance_matrix(
         weights = np.ones(len(non_uniform_points), dtype=int)
     if dtype is None:
         dtype = non_uniform_points.dtype
+        # integer points would truncate the uniform grid
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+    elif not np.issubdtype(dtype, np.floating):
+        raise ValueError(
+            "Expected a floating point dtype, got {}".format(np.dtype(dtype))
+        )
     if len(non_uniform_points) == 0:
         return np.zeros(uniform_grid_size, dtype=dtype)
 
+    # from now on we use one contiguous row for each axis. all the data is
+    # converted to `dtype`, the distances are then computed in `dtype` as well
+    non_uniform_points = np.ascontiguousarray(
+        non_uniform_points.T, dtype=dtype
+    )
+    weights = weights.astype(dtype, copy=False)
+
     # bins should divide properly the grid
     assert np.all(np.mod(uniform_grid_size, bins_size) == 0)
 
@@ -371,20 +581,53 @@ def mapped_distance_matrix(
     )
     lower_left = -(max_distance_in_cells * uniform_grid_cell_step)
     reference_bin += lower_left + cell_reference_point_offset
+    # one contiguous row for each axis, in the same layout of the points
+    reference_bin = np.ascontiguousarray(
+        np.moveaxis(reference_bin, -1, 0), dtype=dtype
+    )
+    # the reference bin is shared by all the subproblems, we move it to the
+    # workers only once instead of embedding it into each task. the key is not
+    # derived from the content, otherwise concurrent or consecutive calls with
+    # the same reference bin would share (and release) the same data
+    if scatter:
+        reference_bin = client.scatter(
+            reference_bin, broadcast=True, hash=False
+        )
 
-    # start computation of the mapped distance
-    mapped_distances_fu = client.map(
-        compute_mapped_distance_on_subgroup,
-        subgroups_coords_fu,
-        uniform_grid_size=uniform_grid_size,
-        uniform_grid_cell_step=uniform_grid_cell_step,
-        bins_size=bins_size,
-        function=func,
-        reference_bin=reference_bin,
-        max_distance=max_distance,
-        max_distance_in_cells=max_distance_in_cells,
-        exact_max_distance=exact_max_distance,
-        dtype=dtype,
+    # pure=False: a deterministic key would require tokenizing all the
+    # arguments (including `func`, possibly pickled by value) at each
+    # submission
+    def submit(subgroup_coords_fu):
+        return client.submit(
+            compute_mapped_distance_on_subgroup,
+            subgroup_coords_fu,
+            pure=False,
+            uniform_grid_size=uniform_grid_size,
+            uniform_grid_cell_step=uniform_grid_cell_step,
+            function=func,
+            reference_bin=reference_bin,
+            max_distance=max_distance,
+            exact_max_distance=exact_max_distance,
+            squared_distance=squared_distance,
+            dtype=dtype,
+        )
+
+    def count_threads():
+        return sum(
+            worker["nthreads"]
+            for worker in client.scheduler_info()["workers"].values()
+        )
+
+    # subproblems are submitted dynamically: we keep two subproblems per
+    # thread in flight, a new subproblem is submitted each time one is
+    # completed. this way workers which are done with their (smaller)
+    # subproblems get more work, instead of being assigned a fixed share
+    # up front
+    pending = iter(subgroups_coords_fu)
+    n_threads = count_threads()
+    mapped_distances_fu = as_completed(
+        map(submit, islice(pending, max(2 * n_threads, 1))),
+        with_results=True,
     )
 
     mapped_distance = np.zeros(
@@ -392,13 +635,20 @@ def mapped_distance_matrix(
         dtype=dtype,
     )
 
-    for _, (bin_aggregated_grid, bin_bounds) in as_completed(
-        mapped_distances_fu, with_results=True
-    ):
+    for _, (bin_aggregated_grid, bin_bounds) in mapped_distances_fu:
         add_to_slice(
             mapped_distance, bin_aggregated_grid, bin_bounds[0], bin_bounds[1]
         )
 
+        # no workers were registered yet (e.g. the cluster is still scaling
+        # up), we look for them again until some of them show up
+        if n_threads == 0:
+            n_threads = count_threads()
+        for subgroup_coords_fu in islice(
+            pending, max(2 * n_threads, 1) - mapped_distances_fu.count()
+        ):
+            mapped_distances_fu.add(submit(subgroup_coords_fu))
+
     return periodic_inner_sum(
         mapped_distance,
         max_distance_in_cells,
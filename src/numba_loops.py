@@ -96,17 +96,13 @@ def distribute_and_start_subproblems(
     linearized_bin_coords = np.ravel_multi_index(
         pts_bin_coords.T, bins_per_axis
     )
-    # augment the linear indexing with the index of the point before using
-    # group by, in order to have an index that we can use to access the
-    # pts array
-    aug_linearized_bin_coords = np.stack(
-        (linearized_bin_coords, np.arange(len(pts))), axis=-1
-    )
-    indexes_inside_bins = group_by(aug_linearized_bin_coords)
+    # group the indexes of the points (which we use to access the pts
+    # array) by bin
+    order, boundaries = group_by(linearized_bin_coords)
 
     # we create subproblems for each bin (i.e. we split points in the
     # same bin in order to treat at most pts_per_future points in each Future)
-    subproblems = extract_subproblems(indexes_inside_bins, pts_per_future)
+    subproblems = extract_subproblems(order, boundaries, pts_per_future)
     # each subproblem is treated by a single Future. each bin spawns one or
     # more subproblems.
 
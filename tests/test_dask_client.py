@@ -2,9 +2,16 @@ import sys
 
 sys.path.append("src/")
 
-from dask_client import mapped_distance_matrix
+from dask_client import (
+    distribute_subproblems,
+    generate_uniform_grid,
+    mapped_distance_matrix,
+    reference_bin_bounds_near_subgroup,
+    squared_distances,
+)
 from dask.distributed import Client
 import numpy as np
+import pytest
 
 client = Client(processes=False)
 
@@ -13,6 +20,10 @@ def identity(x):
     return x
 
 
+def identity_out(x, out):
+    return x
+
+
 def test_shape():
     pts = np.zeros((2, 2))
 
@@ -387,3 +398,204 @@ def test_overlapping_points_weight():
     expected[0, [-1, 1]] += 0.4 * np.sqrt(0.3 * 0.3 + 0.01 * 0.01)
 
     np.testing.assert_allclose(m, expected)
+
+
+@pytest.mark.parametrize("exact_max_distance", [True, False])
+def test_squared_distance(exact_max_distance):
+    pts = np.array([[1.0, 1.0], [0.9, 0.91], [0.89, 0.9], [1.19, 1.2]])
+
+    kwargs = dict(
+        uniform_grid_cell_step=np.array([0.3, 0.3]),
+        uniform_grid_size=np.array([4, 4]),
+        bins_size=np.array([2, 2]),
+        non_uniform_points=pts,
+        max_distance=0.31,
+        client=client,
+        weights=np.array([0.5, 0.2, 0.3, 0.4]),
+        exact_max_distance=exact_max_distance,
+    )
+
+    m = mapped_distance_matrix(func=np.square, **kwargs)
+    m_identity = mapped_distance_matrix(func=identity, **kwargs)
+    m2 = mapped_distance_matrix(
+        func=identity_out, squared_distance=True, **kwargs
+    )
+    m3 = mapped_distance_matrix(func=np.sqrt, squared_distance=True, **kwargs)
+
+    np.testing.assert_allclose(m2, m)
+    np.testing.assert_allclose(m3, m_identity)
+
+
+def test_float32():
+    rng = np.random.default_rng(seed=1)
+    pts = 2 * rng.random((30, 2))
+
+    kwargs = dict(
+        uniform_grid_cell_step=np.array([0.1, 0.1]),
+        uniform_grid_size=np.array([20, 20]),
+        bins_size=np.array([4, 4]),
+        max_distance=0.35,
+        func=np.exp,
+        client=client,
+        weights=rng.random(30),
+    )
+
+    m = mapped_distance_matrix(non_uniform_points=pts, **kwargs)
+    m32 = mapped_distance_matrix(
+        non_uniform_points=pts, dtype=np.float32, **kwargs
+    )
+    m32_input = mapped_distance_matrix(
+        non_uniform_points=pts.astype(np.float32), **kwargs
+    )
+
+    assert m32.dtype == np.float32
+    assert m32_input.dtype == np.float32
+    np.testing.assert_allclose(m32, m, rtol=1.0e-5)
+    np.testing.assert_allclose(m32_input, m, rtol=1.0e-5)
+
+
+def test_repeated_no_scatter():
+    rng = np.random.default_rng(seed=2)
+    pts = 2 * rng.random((50, 2))
+
+    kwargs = dict(
+        uniform_grid_cell_step=np.array([0.1, 0.1]),
+        uniform_grid_size=np.array([20, 20]),
+        bins_size=np.array([4, 4]),
+        non_uniform_points=pts,
+        max_distance=0.35,
+        func=np.exp,
+        client=client,
+    )
+
+    m = mapped_distance_matrix(**kwargs)
+    # the subproblems of consecutive calls share the same keys, thus they
+    # must not be modified by the workers
+    ms = [mapped_distance_matrix(scatter=False, **kwargs) for _ in range(3)]
+
+    for m2 in ms:
+        np.testing.assert_allclose(m2, m)
+
+
+def test_float32_subproblems():
+    rng = np.random.default_rng(seed=1)
+    pts = (2 * rng.random((2, 30))).astype(np.float32)
+
+    futures = distribute_subproblems(
+        uniform_grid_cell_step=np.array([0.1, 0.1]),
+        uniform_grid_size=np.array([20, 20]),
+        bins_size=np.array([4, 4]),
+        pts=pts,
+        weights=rng.random(30).astype(np.float32),
+        pts_per_future=5,
+        client=client,
+        scatter=True,
+    )
+
+    for subgroup, _, _, weights in client.gather(futures):
+        assert subgroup.dtype == np.float32
+        assert weights.dtype == np.float32
+
+
+def test_integer_points():
+    pts = np.array([[1, 1], [2, 0]])
+
+    kwargs = dict(
+        uniform_grid_cell_step=np.array([0.5, 0.5]),
+        uniform_grid_size=np.array([8, 8]),
+        bins_size=np.array([2, 2]),
+        max_distance=1,
+        func=identity,
+        client=client,
+    )
+
+    m = mapped_distance_matrix(non_uniform_points=pts, **kwargs)
+    m_float = mapped_distance_matrix(
+        non_uniform_points=pts.astype(float), **kwargs
+    )
+
+    assert m.dtype == np.float64
+    np.testing.assert_allclose(m, m_float)
+
+    with pytest.raises(ValueError):
+        mapped_distance_matrix(non_uniform_points=pts, dtype=int, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "grid_dtype, subgroup_dtype",
+    [
+        (np.float64, np.float64),
+        (np.float32, np.float32),
+        (np.float64, np.float32),
+        (np.float32, np.float64),
+    ],
+)
+def test_squared_distances(grid_dtype, subgroup_dtype):
+    rng = np.random.default_rng(seed=0)
+    g = rng.random((30, 2)).astype(grid_dtype)
+    s = rng.random((7, 2)).astype(subgroup_dtype)
+
+    out = np.empty((30, 7), dtype=np.result_type(g, s))
+    squared_distances(
+        np.ascontiguousarray(g.T), np.ascontiguousarray(s.T), out
+    )
+
+    expected = ((g[:, None] - s[None]) ** 2).sum(-1)
+    np.testing.assert_allclose(
+        out, expected, rtol=1.0e-6 if out.dtype == np.float32 else 1.0e-12
+    )
+
+
+@pytest.mark.parametrize("cell_reference_point_offset", [0, 0.05])
+@pytest.mark.parametrize(
+    "step, max_distance", [(0.25, 0.5), (0.1, 0.3), (0.1, 0.25)]
+)
+def test_reference_bin_bounds_near_subgroup(
+    step, max_distance, cell_reference_point_offset
+):
+    uniform_grid_cell_step = np.array([step, step])
+    bins_size = np.array([4, 4])
+    max_distance_in_cells = np.ceil(
+        max_distance / uniform_grid_cell_step
+    ).astype(int)
+
+    # built as in mapped_distance_matrix
+    reference_bin = generate_uniform_grid(
+        uniform_grid_cell_step, bins_size + 2 * max_distance_in_cells
+    )
+    reference_bin += (
+        -(max_distance_in_cells * uniform_grid_cell_step)
+        + cell_reference_point_offset
+    )
+    reference_bin = np.ascontiguousarray(np.moveaxis(reference_bin, -1, 0))
+
+    # subgroups at the corners of the bin, and one in the middle
+    bin_side = (bins_size * uniform_grid_cell_step)[0]
+    corners = [
+        [0, 0],
+        [0, bin_side],
+        [bin_side, 0],
+        [bin_side, bin_side],
+        [bin_side / 2, bin_side / 2],
+    ]
+    for corner in corners:
+        subgroup = np.array(corner, dtype=float)[:, None]
+        lower, upper = reference_bin_bounds_near_subgroup(
+            reference_bin, subgroup, max_distance
+        )
+
+        dist = np.sqrt(
+            np.sum((reference_bin - subgroup[..., None]) ** 2, axis=0)
+        )
+        inside = np.zeros(dist.shape, dtype=bool)
+        inside[lower[0] : upper[0], lower[1] : upper[1]] = True
+        # no uniform point in range is left outside the slice
+        assert not np.any((dist <= max_distance) & ~inside)
+        # the slice is at most one cell larger than the bounding box of the
+        # uniform points in range on each side
+        for axis in range(2):
+            nearby = np.nonzero(
+                np.abs(reference_bin[axis] - subgroup[axis]) <= max_distance
+            )[axis]
+            assert lower[axis] >= nearby.min() - 1
+            assert upper[axis] <= nearby.max() + 2